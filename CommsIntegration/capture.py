@@ -0,0 +1,235 @@
+# Traffic capture for offline replay
+# Records /app_cmd requests, MQTT messages handled by on_message and every
+# mqtt_handle.publish into a compact binary log that replay.py can feed back.
+#
+# Each process writes its own file: CAPTURE_FILE=traffic.cap gives e.g.
+# traffic.main-1234.cap and traffic.http_gateway-1235.cap, which replay.py
+# merges by timestamp.
+#
+# Log layout: MAGIC, then one record per event:
+#   kind (u8) | timestamp_ns (u64) | topic length (u16) | payload length (u32)
+#   | topic (utf-8) | payload (raw bytes)
+
+import atexit
+import json
+import logging
+import os
+import signal
+import struct
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ARCAP\x01"
+RECORD_HEADER = struct.Struct("<BQHI")
+FLUSH_INTERVAL = 1.0  # seconds of buffered records that a hard kill can lose
+
+# Record kinds
+HTTP_CMD = 1  # raw /app_cmd request body
+MQTT_MSG = 2  # message delivered to on_message
+MQTT_PUB = 3  # call to mqtt_handle.publish
+
+KIND_NAMES = {HTTP_CMD: "http_cmd", MQTT_MSG: "mqtt_msg", MQTT_PUB: "mqtt_pub"}
+
+Record = namedtuple("Record", ["kind", "ts_ns", "topic", "payload"])
+
+
+def to_bytes(payload) -> bytes:
+    """Normalise a payload the same way for capture and replay"""
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if isinstance(payload, (dict, list)):
+        return json.dumps(payload, sort_keys=True).encode("utf-8")
+    return str(payload).encode("utf-8")
+
+
+class Recorder:
+    """Thread-safe writer for capture logs, a no-op until started"""
+
+    def __init__(self):
+        self._fh = None
+        # Reentrant, as the SIGTERM handler may interrupt record() on this thread
+        self._lock = threading.RLock()
+        self._flusher_stop = None
+        self._previous_sigterm = None
+
+    @property
+    def active(self) -> bool:
+        return self._fh is not None
+
+    def start(self, path):
+        """Start recording to path, or a numbered variant if it already exists
+
+        Returns the path actually used, or None if capture could not start.
+        Capture problems are logged and never raised, so they cannot take
+        down the gateway being observed.
+        """
+        if not path or self._fh is not None:
+            return None
+        try:
+            path, self._fh = _open_new(os.fspath(path))
+            self._fh.write(MAGIC)
+        except OSError as e:
+            print(f"✗ Traffic capture disabled: {e}")
+            logger.error(f"Traffic capture could not start: {e}")
+            self._close()
+            return None
+        # Flush on a timer, so the tail of a burst reaches disk even when
+        # traffic stops right after it
+        self._flusher_stop = threading.Event()
+        threading.Thread(
+            target=self._flush_loop, args=(self._flusher_stop,), daemon=True
+        ).start()
+        atexit.register(self.stop)
+        # atexit does not run on SIGTERM (docker stop, systemd), so close the
+        # capture from a handler. Signal handlers can only be set on the main thread.
+        if threading.current_thread() is threading.main_thread():
+            previous = signal.getsignal(signal.SIGTERM)
+            if previous is not signal.SIG_IGN:
+                self._previous_sigterm = previous
+                signal.signal(signal.SIGTERM, self._on_sigterm)
+        print(f"✓ Capturing traffic to {path}")
+        logger.info(f"Traffic capture started: {path}")
+        return path
+
+    def stop(self):
+        with self._lock:
+            was_active = self._fh is not None
+            if self._flusher_stop is not None:
+                self._flusher_stop.set()
+                self._flusher_stop = None
+            self._close()
+            previous, self._previous_sigterm = self._previous_sigterm, None
+        on_main = threading.current_thread() is threading.main_thread()
+        if previous is not None and on_main:
+            signal.signal(signal.SIGTERM, previous)
+        if was_active:
+            logger.info("Traffic capture stopped")
+
+    def _close(self):
+        fh, self._fh = self._fh, None
+        if fh is None:
+            return
+        try:
+            fh.close()
+        except OSError as e:
+            logger.error(f"Traffic capture could not be closed cleanly: {e}")
+
+    def _flush_loop(self, stopped):
+        while not stopped.wait(FLUSH_INTERVAL):
+            with self._lock:
+                if self._fh is None:
+                    return
+                try:
+                    self._fh.flush()
+                except OSError as e:
+                    logger.error(f"Traffic capture failed, recording disabled: {e}")
+                    self._close()
+                    return
+
+    def _on_sigterm(self, signum, frame):
+        previous = self._previous_sigterm
+        self.stop()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(128 + signum)
+
+    def record(self, kind, topic, payload):
+        if self._fh is None:
+            return
+        ts_ns = time.time_ns()
+        topic_b = (topic or "").encode("utf-8")
+        payload_b = to_bytes(payload)
+        header = RECORD_HEADER.pack(kind, ts_ns, len(topic_b), len(payload_b))
+        with self._lock:
+            if self._fh is None:
+                return
+            try:
+                self._fh.write(header + topic_b + payload_b)
+            except OSError as e:
+                # e.g. a full disk: stop recording rather than fail the caller
+                logger.error(f"Traffic capture failed, recording disabled: {e}")
+                self._close()
+
+
+def _open_new(path):
+    # Never overwrite an earlier capture; number the new one instead. Containers
+    # often restart with the same PID, so per-process names can repeat.
+    root, ext = os.path.splitext(path)
+    candidate, n = path, 0
+    while True:
+        try:
+            return candidate, open(candidate, "xb")
+        except FileExistsError:
+            n += 1
+            candidate = f"{root}-{n}{ext}"
+
+
+recorder = Recorder()
+
+
+def process_path(base, label):
+    """Per-process capture path, so processes never share a file"""
+    root, ext = os.path.splitext(base)
+    return f"{root}.{label}-{os.getpid()}{ext or '.cap'}"
+
+
+def start(base, label):
+    if base:
+        recorder.start(process_path(base, label))
+
+
+def record_http(body):
+    recorder.record(HTTP_CMD, "/app_cmd", body)
+
+
+def record_message(msg):
+    recorder.record(MQTT_MSG, msg.topic, msg.payload)
+
+
+def instrument(client):
+    """Wrap client.publish so that every publish is recorded"""
+    publish = client.publish
+
+    def recording_publish(topic, payload=None, *args, **kwargs):
+        recorder.record(MQTT_PUB, topic, payload)
+        return publish(topic, payload, *args, **kwargs)
+
+    client.publish = recording_publish
+    return client
+
+
+def read_captures(paths):
+    """Records from several capture logs, merged by timestamp"""
+    records = [rec for path in paths for rec in read_capture(path)]
+    records.sort(key=lambda rec: rec.ts_ns)
+    return records
+
+
+def read_capture(path):
+    """Yield Records from a capture log"""
+    with open(path, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture log")
+        while True:
+            header = fh.read(RECORD_HEADER.size)
+            if not header:
+                break
+            if len(header) < RECORD_HEADER.size:
+                logger.warning(f"Truncated record header at end of {path}")
+                break
+            kind, ts_ns, topic_len, payload_len = RECORD_HEADER.unpack(header)
+            body = fh.read(topic_len + payload_len)
+            if len(body) < topic_len + payload_len:
+                logger.warning(f"Truncated record body at end of {path}")
+                break
+            yield Record(
+                kind, ts_ns, body[:topic_len].decode("utf-8"), body[topic_len:]
+            )
@@ -1,10 +1,13 @@
 import json
 import logging
+import os
 
 import redis
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 
+import capture
+
 load_dotenv()
 
 # Load same config as main.py
@@ -44,6 +47,7 @@ red = setup_redis()
 @app.route("/app_cmd", methods=["POST"])
 def flutter_cmd():
     try:
+        capture.record_http(request.get_data())
         data = request.json
 
         # Validate input
@@ -85,5 +89,6 @@ def health():
 
 
 if __name__ == "__main__":
+    capture.start(os.getenv("CAPTURE_FILE"), "http_gateway")
     print("Starting HTTP Gateway on port 5000...")
     app.run(host="0.0.0.0", port=5000, debug=False)
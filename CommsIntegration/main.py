@@ -11,6 +11,8 @@ import paho.mqtt.client as mqtt
 import redis
 from dotenv import load_dotenv
 
+import capture
+
 # import sentry_sdk
 
 load_dotenv()
@@ -61,6 +63,7 @@ mqtt_handle = mqtt.Client(
 )
 
 mqtt_handle.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASS"))
+capture.instrument(mqtt_handle)
 
 global max_retries
 max_retries = 10
@@ -90,6 +93,7 @@ def on_connect(client, userdata, flags, reason_code, properties):
 
 
 def on_message(client, userdata, msg):
+    capture.record_message(msg)
     if msg.topic in ERROR_TOPICS:
         data = json.loads(msg.payload)
         if data["status"] == "ERROR":
@@ -171,6 +175,7 @@ def process_queue():
 
 def main():
     print("Hello from commsintegration!")
+    capture.start(os.getenv("CAPTURE_FILE"), "main")
     # sentry_sdk.profiler.start_profiler()
 
     # Starting MQTT thread
@@ -13,6 +13,8 @@ import redis
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
 
+import capture
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -114,6 +116,7 @@ mqtt_handle = mqtt.Client(
 )
 
 mqtt_handle.username_pw_set(os.getenv("MQTT_USER"), os.getenv("MQTT_PASS"))
+capture.instrument(mqtt_handle)
 
 
 def clr_queue():
@@ -139,6 +142,7 @@ def on_connect(client, userdata, flags, reason_code, properties):
 
 def on_message(client, userdata, msg):
     """MQTT message callback - handles ESP device feedback"""
+    capture.record_message(msg)
     if msg.topic in ERROR_TOPICS:
         data = json.loads(msg.payload)
         if data["status"] == "ERROR":
@@ -168,6 +172,7 @@ def flutter_cmd():
     Expected JSON: {"cmd": "forward"} or {"topic": "SYS/CMD", "body": {...}}
     """
     try:
+        capture.record_http(request.get_data())
         data = request.json
         
         # Validate input
@@ -330,6 +335,7 @@ def main():
     print("=" * 60)
     print("HTTP API-Based Communication System Starting...")
     print("=" * 60)
+    capture.start(os.getenv("CAPTURE_FILE"), "main_webber")
     
     # Start Flask in background thread
     flask_thread = threading.Thread(target=run_flask, daemon=True)
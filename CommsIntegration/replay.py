@@ -0,0 +1,422 @@
+# Replays a capture log (see capture.py) through the HTTP gateway and the
+# command dispatcher, using in-process Redis and MQTT stand-ins, then reports
+# dispatch ordering divergence and latency percentiles.
+#
+# Targets:
+#   main_webber  main_webber.py handles /app_cmd, MQTT and dispatching
+#   main         main.py handles MQTT and dispatching, http_gateway.py /app_cmd
+#
+# Usage (from this directory):
+#   CAPTURE_FILE=traffic.cap uv run main_webber.py    # record
+#   uv run replay.py traffic.main_webber-*.cap --speed 10
+#   uv run replay.py traffic.main-*.cap traffic.http_gateway-*.cap --target main
+
+import argparse
+import importlib
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from types import SimpleNamespace
+from unittest import mock
+
+import redis
+
+import capture
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Matches commands pushed to the queue with the publish that sends them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(deque)
+        self.samples = defaultdict(list)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def enqueued(self, value):
+        try:
+            command = json.loads(value)
+            key = (command["topic"], capture.to_bytes(command["body"]))
+        except (ValueError, TypeError, KeyError):
+            return
+        with self._lock:
+            self._pending[key].append(time.perf_counter())
+
+    def published(self, topic, payload):
+        key = (topic, capture.to_bytes(payload))
+        with self._lock:
+            if self._pending[key]:
+                queued_at = self._pending[key].popleft()
+                self.samples["dispatch"].append(time.perf_counter() - queued_at)
+
+
+class StubRedis:
+    """In-memory stand-in for the Redis list commands used by the gateway"""
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+        self._lists = {}
+        self._cond = threading.Condition()
+        # When a blocking pop started waiting on an empty list, None while busy
+        self.blocked_since = None
+
+    def ping(self):
+        return True
+
+    def rpush(self, key, *values):
+        with self._cond:
+            items = self._lists.setdefault(key, deque())
+            items.extend(values)
+            self._cond.notify_all()
+            length = len(items)
+        if key == "commands":
+            for value in values:
+                self._tracker.enqueued(value)
+        return length
+
+    def llen(self, key):
+        with self._cond:
+            return len(self._lists.get(key, ()))
+
+    def lrange(self, key, start, end):
+        with self._cond:
+            items = list(self._lists.get(key, ()))
+        if end < 0:
+            end += len(items)
+        return items[start : end + 1]
+
+    def lrem(self, key, count, value):
+        with self._cond:
+            items = self._lists.get(key)
+            if not items:
+                return 0
+            order = list(reversed(items)) if count < 0 else list(items)
+            limit = abs(count) or len(order)
+            kept, removed = [], 0
+            for item in order:
+                if item == value and removed < limit:
+                    removed += 1
+                else:
+                    kept.append(item)
+            if count < 0:
+                kept.reverse()
+            self._set(key, deque(kept))
+            return removed
+
+    def rename(self, src, dst):
+        with self._cond:
+            if src not in self._lists:
+                raise redis.ResponseError("no such key")
+            self._lists[dst] = self._lists.pop(src)
+            self._cond.notify_all()
+            return True
+
+    def brpoplpush(self, src, dst, timeout=0):
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            while not self._lists.get(src):
+                if self.blocked_since is None:
+                    self.blocked_since = time.monotonic()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self.blocked_since = None
+            value = self._lists[src].pop()
+            self._set(src, self._lists[src])
+            self._lists.setdefault(dst, deque()).appendleft(value)
+            return value
+
+    def _set(self, key, items):
+        # Redis deletes empty lists, which matters for RENAME
+        if items:
+            self._lists[key] = items
+        else:
+            self._lists.pop(key, None)
+
+
+class StubMQTT:
+    """Stand-in for the paho client that records what gets published"""
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+        self._lock = threading.Lock()
+        self.published = []
+        self.errors = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with self._lock:
+            self.published.append((topic, capture.to_bytes(payload)))
+        # Same payload validation as paho, so retry paths behave as in production
+        if not isinstance(payload, (str, bytes, bytearray, int, float, type(None))):
+            with self._lock:
+                self.errors += 1
+            raise TypeError("payload must be a string, bytearray, int, float or None.")
+        self._tracker.published(topic, payload)
+        return SimpleNamespace(rc=0, mid=len(self.published))
+
+
+TARGETS = {
+    # target: (module with on_message/process_queue, module with /app_cmd)
+    "main_webber": ("main_webber", "main_webber"),
+    "main": ("main", "http_gateway"),
+}
+
+
+def _fresh_import(name):
+    # Reimport so that dispatchers from an earlier replay keep their own stubs
+    sys.modules.pop(name, None)
+    return importlib.import_module(name)
+
+
+def load_gateway(stub_red, stub_mqtt, target="main_webber"):
+    """Import the target's modules wired to the stand-ins instead of real servers
+
+    Returns (dispatcher module, HTTP gateway module).
+    """
+    names = TARGETS[target]
+    modules = {}
+    # Never record the replay itself, whatever CAPTURE_FILE or .env say
+    capture.recorder.stop()
+    with (
+        mock.patch.object(capture, "start"),
+        mock.patch.object(redis, "ConnectionPool"),
+        mock.patch.object(redis, "Redis", return_value=stub_red),
+    ):
+        for name in dict.fromkeys(names):
+            modules[name] = _fresh_import(name)
+    for module in modules.values():
+        module.red = stub_red
+        if hasattr(module, "mqtt_handle"):
+            module.mqtt_handle = stub_mqtt
+    return modules[names[0]], modules[names[1]]
+
+
+def feed(records, origin_ns, speed, handler):
+    """Deliver records to handler, preserving capture spacing divided by speed"""
+    started = time.perf_counter()
+    for rec in records:
+        if speed is not None:
+            due = (rec.ts_ns - origin_ns) / 1e9 / speed
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            handler(rec)
+        except Exception as e:
+            logger.error(f"Replay of {capture.KIND_NAMES[rec.kind]} failed: {e}")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[idx]
+
+
+def normalise(topic, payload):
+    """Comparison key for a publish, ignoring fields that change on every run"""
+    if topic != "SYS/ERR":
+        return (topic, payload)
+    # Failure reports carry timestamps and stringified MQTT messages, so only
+    # their status is stable. main.py double-encodes them, hence the loop.
+    data = payload
+    for _ in range(2):
+        try:
+            data = json.loads(data)
+        except (ValueError, TypeError):
+            break
+        if not isinstance(data, str):
+            break
+    status = data.get("status", "") if isinstance(data, dict) else ""
+    return (topic, str(status).encode("utf-8"))
+
+
+def report_ordering(expected, actual):
+    # Linear on purpose: command streams are long and highly repetitive
+    first = next(
+        (i for i, (a, b) in enumerate(zip(expected, actual)) if a != b),
+        None if len(expected) == len(actual) else min(len(expected), len(actual)),
+    )
+    prefix = min(len(expected), len(actual)) if first is None else first
+    missing = sum((Counter(expected) - Counter(actual)).values())
+    extra = sum((Counter(actual) - Counter(expected)).values())
+
+    print("Dispatch ordering:")
+    print(f"  captured publishes: {len(expected)}")
+    print(f"  replayed publishes: {len(actual)}")
+    print(f"  matching prefix:    {prefix}")
+    print(f"  missing / extra:    {missing} / {extra}")
+    if first is None:
+        print("  ✓ no divergence")
+    else:
+        print(f"  ✗ first divergence at publish #{first}")
+        for label, seq in (("captured", expected), ("replayed", actual)):
+            if first < len(seq):
+                topic, payload = seq[first]
+                print(f"    {label}: {topic} {payload[:80]!r}")
+    return first is None
+
+
+def report_latency(samples):
+    print("Latency (ms):")
+    for name in ("http", "on_message", "dispatch"):
+        values = samples.get(name)
+        if not values:
+            print(f"  {name:<11} no samples")
+            continue
+        p50, p90, p99 = (percentile(values, p) * 1000 for p in (50, 90, 99))
+        print(
+            f"  {name:<11} n={len(values):<6} p50={p50:.2f} p90={p90:.2f} "
+            f"p99={p99:.2f} max={max(values) * 1000:.2f}"
+        )
+
+
+def replay(paths, speed, settle, drain_timeout, target="main_webber"):
+    records = capture.read_captures(paths)
+    # HTTP and MQTT inputs stay in one stream, so their interleaving is kept
+    inputs = [r for r in records if r.kind in (capture.HTTP_CMD, capture.MQTT_MSG)]
+    http_count = sum(r.kind == capture.HTTP_CMD for r in inputs)
+    expected = [
+        normalise(r.topic, r.payload) for r in records if r.kind == capture.MQTT_PUB
+    ]
+    if not records:
+        print(f"✗ {', '.join(map(str, paths))} contain no records")
+        return False
+    origin_ns = records[0].ts_ns
+
+    tracker = LatencyTracker()
+    stub_red = StubRedis(tracker)
+    stub_mqtt = StubMQTT(tracker)
+    dispatcher_module, gateway = load_gateway(stub_red, stub_mqtt, target)
+    client = gateway.app.test_client()
+
+    def send_http(rec):
+        started = time.perf_counter()
+        client.post("/app_cmd", data=rec.payload, content_type="application/json")
+        tracker.add("http", time.perf_counter() - started)
+
+    def send_mqtt(rec):
+        msg = SimpleNamespace(topic=rec.topic, payload=rec.payload, qos=0, retain=False)
+        started = time.perf_counter()
+        dispatcher_module.on_message(None, None, msg)
+        tracker.add("on_message", time.perf_counter() - started)
+
+    def send(rec):
+        if rec.kind == capture.HTTP_CMD:
+            send_http(rec)
+        else:
+            send_mqtt(rec)
+
+    print(
+        f"Replaying {http_count} HTTP commands and {len(inputs) - http_count} "
+        f"MQTT messages through {target} "
+        f"at {'max' if speed is None else f'{speed:g}x'} speed..."
+    )
+    crashes = []
+
+    def dispatch():
+        try:
+            dispatcher_module.process_queue()
+        except Exception as e:
+            crashes.append(e)
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+    started = time.monotonic()
+    feed(inputs, origin_ns, speed, send)
+
+    # Let the dispatcher drain, including its retry back-off
+    fed = time.monotonic()
+    deadline = fed + drain_timeout
+    while time.monotonic() < deadline:
+        if not dispatcher.is_alive():
+            break
+        blocked_since = stub_red.blocked_since
+        if blocked_since is not None:
+            if time.monotonic() - max(fed, blocked_since) >= settle:
+                break
+        time.sleep(0.1)
+    else:
+        print(f"✗ Dispatcher did not settle within {drain_timeout}s")
+    if crashes:
+        print(f"✗ Dispatcher crashed: {type(crashes[0]).__name__}: {crashes[0]}")
+    print(f"✓ Replay finished in {time.monotonic() - started:.2f}s")
+    if stub_mqtt.errors:
+        print(f"  publish errors: {stub_mqtt.errors}")
+
+    with stub_mqtt._lock:
+        actual = [normalise(topic, payload) for topic, payload in stub_mqtt.published]
+    in_order = report_ordering(expected, actual)
+    report_latency(tracker.samples)
+    return in_order and not crashes
+
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay captured gateway traffic against local stand-ins"
+    )
+    parser.add_argument(
+        "captures",
+        nargs="+",
+        help="capture logs written with CAPTURE_FILE, merged by timestamp",
+    )
+    parser.add_argument(
+        "--speed",
+        type=parse_speed,
+        default=1.0,
+        help="replay speed: 1, 10 (or any factor) or max (default: 1)",
+    )
+    parser.add_argument(
+        "--target",
+        choices=sorted(TARGETS),
+        default="main_webber",
+        help="deployment the capture was taken from (default: main_webber)",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=1.0,
+        help="seconds the dispatcher must wait on an empty queue to count as idle",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=120.0,
+        help="maximum seconds to wait for the dispatcher after feeding",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit with status 1 if ordering diverges or the dispatcher crashes",
+    )
+    args = parser.parse_args()
+
+    ok = replay(
+        args.captures, args.speed, args.settle, args.drain_timeout, args.target
+    )
+    if args.strict and not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import capture
+
+BODY = b'{"cmd": "forward"}'
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+
+def write_capture(path, monkeypatch):
+    recorder = capture.Recorder()
+    monkeypatch.setattr(capture, "recorder", recorder)
+    recorder.start(path)
+    client = capture.instrument(SimpleNamespace(publish=lambda *args, **kw: None))
+    capture.record_http(BODY)
+    capture.record_message(SimpleNamespace(topic="esp32/sense", payload=b"{}"))
+    client.publish("esp32/legs/cmd", {"cmd": "forward"}, qos=1)
+    recorder.stop()
+
+
+def test_round_trip(tmp_path, monkeypatch):
+    path = tmp_path / "t.cap"
+    write_capture(path, monkeypatch)
+
+    records = list(capture.read_capture(path))
+
+    assert [(r.kind, r.topic, r.payload) for r in records] == [
+        (capture.HTTP_CMD, "/app_cmd", BODY),
+        (capture.MQTT_MSG, "esp32/sense", b"{}"),
+        (capture.MQTT_PUB, "esp32/legs/cmd", BODY),
+    ]
+    assert [r.ts_ns for r in records] == sorted(r.ts_ns for r in records)
+
+
+@pytest.mark.parametrize("cut", [1, 5, capture.RECORD_HEADER.size + 3])
+def test_truncated_record_is_dropped(tmp_path, monkeypatch, cut):
+    path = tmp_path / "t.cap"
+    write_capture(path, monkeypatch)
+    data = path.read_bytes()
+    last_record = capture.RECORD_HEADER.size + len(b"esp32/legs/cmd") + len(BODY)
+    path.write_bytes(data[: len(data) - last_record + cut])
+
+    records = list(capture.read_capture(path))
+
+    assert [r.kind for r in records] == [capture.HTTP_CMD, capture.MQTT_MSG]
+
+
+def test_rejects_foreign_file(tmp_path):
+    path = tmp_path / "t.cap"
+    path.write_bytes(b"not a capture")
+
+    with pytest.raises(ValueError):
+        list(capture.read_capture(path))
+
+
+def test_never_overwrites(tmp_path):
+    path = tmp_path / "t.cap"
+    path.write_bytes(b"earlier capture")
+    (tmp_path / "t-1.cap").write_bytes(b"earlier capture")
+    recorder = capture.Recorder()
+
+    assert recorder.start(path) == str(tmp_path / "t-2.cap")
+    recorder.stop()
+    assert path.read_bytes() == b"earlier capture"
+    assert (tmp_path / "t-1.cap").read_bytes() == b"earlier capture"
+
+
+def test_start_failure_disables_capture(tmp_path):
+    recorder = capture.Recorder()
+
+    assert recorder.start(tmp_path / "missing" / "t.cap") is None
+    assert not recorder.active
+    recorder.record(capture.HTTP_CMD, "/app_cmd", BODY)
+
+
+def test_write_failure_disables_capture(tmp_path, monkeypatch):
+    recorder = capture.Recorder()
+    recorder.start(tmp_path / "t.cap")
+
+    def disk_full(data):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(recorder._fh, "write", disk_full)
+    published = []
+    monkeypatch.setattr(capture, "recorder", recorder)
+    client = capture.instrument(SimpleNamespace(publish=lambda *a: published.append(a)))
+
+    client.publish("esp32/legs/cmd", "forward")
+
+    assert published == [("esp32/legs/cmd", "forward")]
+    assert not recorder.active
+    recorder.stop()
+
+
+def test_process_path_is_per_process():
+    path = capture.process_path("/data/traffic.cap", "main")
+
+    assert path == f"/data/traffic.main-{os.getpid()}.cap"
+
+
+def test_read_captures_merges_by_timestamp(tmp_path):
+    paths = []
+    for name in ("a", "b"):
+        recorder = capture.Recorder()
+        recorder.start(tmp_path / f"{name}.cap")
+        paths.append(tmp_path / f"{name}.cap")
+        recorder.record(capture.MQTT_MSG, name, b"1")
+        recorder.stop()
+    recorder = capture.Recorder()
+    recorder.start(tmp_path / "c.cap")
+    recorder.record(capture.MQTT_MSG, "c", b"")
+    recorder.stop()
+
+    records = capture.read_captures([tmp_path / "c.cap", *paths])
+
+    assert [r.topic for r in records] == ["a", "b", "c"]
+
+
+def test_sigterm_handler_is_restored(tmp_path):
+    previous = signal.getsignal(signal.SIGTERM)
+    recorder = capture.Recorder()
+
+    recorder.start(tmp_path / "t.cap")
+    assert signal.getsignal(signal.SIGTERM) == recorder._on_sigterm
+    recorder.stop()
+
+    assert signal.getsignal(signal.SIGTERM) == previous
+
+
+def run_capture_process(path, script):
+    """Start a Python process that records 50 records to path, then runs script"""
+    code = textwrap.dedent(f"""
+        import os, sys, time
+        import capture
+        recorder = capture.Recorder()
+        recorder.start({str(path)!r})
+        for i in range(50):
+            recorder.record(capture.HTTP_CMD, "/app_cmd", b"%d" % i)
+        print("recorded", flush=True)
+    """) + textwrap.dedent(script)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(PROJECT_DIR), *sys.path]))
+    return subprocess.Popen(
+        [sys.executable, "-c", code], env=env, stdout=subprocess.PIPE, text=True
+    )
+
+
+def test_idle_records_survive_hard_exit(tmp_path):
+    path = tmp_path / "t.cap"
+    proc = run_capture_process(
+        path, f"time.sleep({capture.FLUSH_INTERVAL * 1.5}); os._exit(0)"
+    )
+
+    assert proc.wait(timeout=10) == 0
+    assert len(list(capture.read_capture(path))) == 50
+
+
+def test_records_survive_sigterm(tmp_path):
+    path = tmp_path / "t.cap"
+    proc = run_capture_process(path, "time.sleep(30)")
+    assert "recorded\n" in iter(proc.stdout.readline, "")
+
+    proc.send_signal(signal.SIGTERM)
+
+    assert proc.wait(timeout=10) == 128 + signal.SIGTERM
+    records = list(capture.read_capture(path))
+    assert [r.payload for r in records] == [b"%d" % i for i in range(50)]